@@ -1,6 +1,6 @@
 from flask import Flask, request, send_file, jsonify
 from flask_cors import CORS
-from gtts import gTTS
+from tts_backends import build_router, TTSBackendError
 import io
 import os
 import re
@@ -20,6 +20,12 @@ CORS(app, resources={r"/*": {"origins": allowed_origins}})
 # Limits
 MAX_TEXT_LENGTH = int(os.environ.get('MAX_TTS_TEXT_LENGTH', 5000))
 
+# TTS routing: comma-separated backends, primary first
+tts_router = build_router(
+    [name.strip() for name in os.environ.get('TTS_BACKENDS', 'gtts,pyttsx3').split(',') if name.strip()],
+    hedging=os.environ.get('TTS_HEDGING', '1') != '0'
+)
+
 
 def clean_text_for_speech(text: str) -> str:
     """Clean user-provided text to improve TTS output."""
@@ -80,28 +86,35 @@ def text_to_speech():
         logger.info(f'Generating TTS (chars={len(clean_text)}, lang={lang})')
 
         # Create TTS
-        tts = gTTS(text=clean_text, lang=lang, slow=False)
-
-        audio_fp = io.BytesIO()
-        tts.write_to_fp(audio_fp)
-        audio_fp.seek(0)
+        result = tts_router.synthesize(clean_text, lang=lang)
 
         duration = time.time() - start_time
-        logger.info(f'TTS generated in {duration:.2f}s')
+        logger.info(f'TTS generated by {result.backend} in {duration:.2f}s')
 
         # Return streaming file response
-        return send_file(
-            audio_fp,
-            mimetype='audio/mpeg',
+        response = send_file(
+            io.BytesIO(result.audio),
+            mimetype=result.mimetype,
             as_attachment=False,
-            download_name='speech.mp3'
+            download_name=f'speech.{result.format}'
         )
+        response.headers['X-TTS-Backend'] = result.backend
+        return response
 
+    except TTSBackendError as e:
+        logger.error(f'TTS backends unavailable: {e}')
+        return jsonify({'error': 'TTS generation failed', 'message': str(e)}), 503
     except Exception as e:
         logger.exception('Error generating TTS')
         return jsonify({'error': 'TTS generation failed', 'message': str(e)}), 500
 
 
+@app.route('/api/tts/backends', methods=['GET'])
+def get_tts_backends():
+    """Per-backend latency, error and circuit breaker stats."""
+    return jsonify(tts_router.stats()), 200
+
+
 @app.route('/', methods=['GET'])
 def root():
     return jsonify({
@@ -109,6 +122,7 @@ def root():
         'status': 'running',
         'endpoints': {
             '/api/tts': 'POST - Convert text to speech (JSON `{ "text": "..." }`)',
+            '/api/tts/backends': 'GET - TTS backend latency and circuit state',
             '/health': 'GET - Health check'
         }
     })
@@ -0,0 +1,319 @@
+"""
+On-demand request profiling for the speech server
+=====================================================
+- Per-request: a caller presenting the profiling token (X-Profile header,
+  ?profile= query arg, or 'profile' key on socket events) gets that one
+  request sampled; the profile is stored as collapsed stacks
+  ("frame;frame;frame count"), ready for flamegraph.pl / speedscope
+- Continuous: a low-rate sampler aggregates every thread's stacks and
+  writes one collapsed-stack file per flush interval
+
+With no token configured the decorators return the handler unchanged,
+so disabled profiling costs nothing per request. Stored profiles are
+capped at max_files; the oldest are deleted first.
+"""
+
+import os
+import re
+import sys
+import glob
+import hmac
+import time
+import uuid
+import logging
+import threading
+import contextvars
+from collections import Counter
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import request, make_response
+from flask_socketio import emit
+
+logger = logging.getLogger(__name__)
+
+PROFILE_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]+$')
+
+# Sampler of the request being profiled; worker threads doing that
+# request's work attach themselves to it via attach_thread()
+active_sampler = contextvars.ContextVar('active_sampler', default=None)
+
+
+def datetime_stamp():
+    return time.strftime('%Y%m%d_%H%M%S')
+
+
+def format_frame(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def fold_stack(frame, root=None):
+    """Collapse a frame chain into a root-first 'a;b;c' string"""
+    names = []
+    while frame is not None:
+        names.append(format_frame(frame))
+        frame = frame.f_back
+    if root:
+        names.append(root)
+    return ';'.join(reversed(names))
+
+
+def write_folded(counts, path):
+    with open(path, 'w', encoding='utf-8') as f:
+        for stack, count in counts.most_common():
+            f.write(f"{stack} {count}\n")
+
+
+def prune_profiles(output_dir, max_files):
+    """Delete the oldest stored profiles beyond max_files"""
+    if not max_files or max_files <= 0:
+        return
+    paths = sorted(glob.glob(os.path.join(output_dir, '*.folded')), key=os.path.getmtime)
+    for path in paths[:-max_files]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+@contextmanager
+def attach_thread():
+    """Include the current (worker) thread in the active request profile"""
+    sampler = active_sampler.get()
+    if sampler is None:
+        yield
+        return
+    sampler.add_thread(threading.get_ident(), threading.current_thread().name)
+    try:
+        yield
+    finally:
+        sampler.remove_thread(threading.get_ident())
+
+
+class StackSampler:
+    """Samples the stacks of selected threads from a background thread"""
+
+    def __init__(self, thread_ids, interval=0.002):
+        self.threads = {tid: None for tid in thread_ids}
+        self.interval = interval
+        self.counts = Counter()
+        self.samples = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profiler-sampler', daemon=True)
+
+    def add_thread(self, tid, label):
+        with self._lock:
+            self.threads[tid] = label
+
+    def remove_thread(self, tid):
+        with self._lock:
+            self.threads.pop(tid, None)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self.counts
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            with self._lock:
+                targets = list(self.threads.items())
+            for tid, label in targets:
+                frame = frames.get(tid)
+                if frame is not None:
+                    self.counts[fold_stack(frame, root=label)] += 1
+            self.samples += 1
+
+
+class RequestProfile:
+    """One profiled request; the id is known up front so it can go in headers"""
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        safe_name = re.sub(r'[^A-Za-z0-9_-]', '_', name)
+        self.id = f"{datetime_stamp()}-{safe_name}-{uuid.uuid4().hex[:8]}"
+        self.sampler = StackSampler([threading.get_ident()], profiler.interval).start()
+        self.start = time.perf_counter()
+        self.info = None
+
+    @contextmanager
+    def active(self):
+        """Mark code running on this thread as part of the profile"""
+        token = active_sampler.set(self.sampler)
+        try:
+            yield
+        finally:
+            active_sampler.reset(token)
+
+    def finish(self):
+        if self.info is not None:
+            return self.info
+        elapsed = time.perf_counter() - self.start
+        counts = self.sampler.stop()
+        output_dir = self.profiler.output_dir
+        os.makedirs(output_dir, exist_ok=True)
+        write_folded(counts, os.path.join(output_dir, f"{self.id}.folded"))
+        prune_profiles(output_dir, self.profiler.max_files)
+        logger.info(f"Profiled {self.name}: {elapsed * 1000:.1f}ms, {self.sampler.samples} samples -> {self.id}")
+        self.info = {
+            'id': self.id,
+            'duration_ms': round(elapsed * 1000, 1),
+            'samples': self.sampler.samples
+        }
+        return self.info
+
+
+class ProfiledBody:
+    """Streamed response body that keeps its request profile running until closed"""
+
+    def __init__(self, profile, body):
+        self.profile = profile
+        self.body = body
+
+    def __iter__(self):
+        iterator = iter(self.body)
+        while True:
+            with self.profile.active():
+                try:
+                    chunk = next(iterator)
+                except StopIteration:
+                    return
+            yield chunk
+
+    def close(self):
+        # The WSGI server always calls close(), even if the body was never iterated
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            self.profile.finish()
+
+
+class RequestProfiler:
+    """Token-gated per-request sampling for Flask routes and Socket.IO events"""
+
+    def __init__(self, token=None, output_dir='profiles', interval=0.002, max_files=200):
+        self.token = token
+        self.output_dir = output_dir
+        self.interval = interval
+        self.max_files = max_files
+
+    @property
+    def enabled(self):
+        return bool(self.token)
+
+    def authorized(self, supplied):
+        if not self.enabled or not supplied:
+            return False
+        # Compare bytes: compare_digest rejects non-ASCII str input
+        return hmac.compare_digest(str(supplied).encode('utf-8'), self.token.encode('utf-8'))
+
+    def path_for(self, profile_id):
+        if not PROFILE_ID_PATTERN.match(profile_id):
+            return None
+        path = os.path.join(self.output_dir, f"{profile_id}.folded")
+        return path if os.path.exists(path) else None
+
+    def route(self, f):
+        """Profile a Flask view when the request carries the token.
+        Generated (streamed) bodies are profiled until fully produced and their
+        duration is logged rather than sent as a header. send_file bodies are
+        already complete, so they get X-Profile-Duration-Ms like JSON responses."""
+        if not self.enabled:
+            return f
+
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            supplied = request.headers.get('X-Profile') or request.args.get('profile')
+            if not self.authorized(supplied):
+                return f(*args, **kwargs)
+
+            profile = RequestProfile(self, f.__name__)
+            try:
+                with profile.active():
+                    response = make_response(f(*args, **kwargs))
+            except Exception:
+                profile.finish()
+                raise
+
+            response.headers['X-Profile-Id'] = profile.id
+            # send_file wraps finished audio in a FileWrapper, which Werkzeug
+            # reports as streamed; only generator bodies still have work to do
+            if response.is_streamed and not response.direct_passthrough:
+                response.response = ProfiledBody(profile, response.response)
+                return response
+
+            info = profile.finish()
+            response.headers['X-Profile-Duration-Ms'] = str(info['duration_ms'])
+            return response
+        return wrapper
+
+    def event(self, f):
+        """Profile a Socket.IO handler when its payload carries the token"""
+        if not self.enabled:
+            return f
+
+        @wraps(f)
+        def wrapper(data=None, *args, **kwargs):
+            supplied = data.get('profile') if isinstance(data, dict) else None
+            if not self.authorized(supplied):
+                return f(data, *args, **kwargs)
+
+            profile = RequestProfile(self, f.__name__)
+            try:
+                with profile.active():
+                    return f(data, *args, **kwargs)
+            finally:
+                emit('profile_result', profile.finish())
+        return wrapper
+
+
+class ContinuousProfiler:
+    """Low-rate sampling of all threads, flushed to disk periodically"""
+
+    def __init__(self, output_dir='profiles', hz=10.0, flush_interval=60.0, max_files=200):
+        self.output_dir = output_dir
+        self.interval = 1.0 / hz
+        self.flush_interval = flush_interval
+        self.max_files = max_files
+        self.counts = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profiler-continuous', daemon=True)
+
+    def start(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        self._thread.start()
+        logger.info(f"Continuous profiling at {1.0 / self.interval:.1f}Hz -> {self.output_dir}")
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.flush()
+
+    def flush(self):
+        if not self.counts:
+            return
+        counts, self.counts = self.counts, Counter()
+        write_folded(counts, os.path.join(self.output_dir, f"continuous-{datetime_stamp()}.folded"))
+        prune_profiles(self.output_dir, self.max_files)
+
+    def _run(self):
+        own = threading.get_ident()
+        last_flush = time.monotonic()
+        while not self._stop.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for tid, frame in sys._current_frames().items():
+                if tid != own:
+                    self.counts[fold_stack(frame, root=names.get(tid, str(tid)))] += 1
+            if time.monotonic() - last_flush >= self.flush_interval:
+                self.flush()
+                last_flush = time.monotonic()
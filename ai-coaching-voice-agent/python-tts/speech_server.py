@@ -2,7 +2,7 @@
 Advanced Speech Server for AI Coaching Voice Agent
 =====================================================
 Features:
-- Text-to-Speech (gTTS + pyttsx3 fallback)
+- Text-to-Speech (pluggable backends: gTTS + pyttsx3 hedged failover)
 - Speech-to-Text (Vosk - offline capable)
 - Real-time WebSocket streaming
 - Audio processing and noise reduction
@@ -17,8 +17,9 @@ Version: 2.0.0
 from flask import Flask, request, send_file, jsonify, Response
 from flask_cors import CORS
 from flask_socketio import SocketIO, emit
-from gtts import gTTS
-import pyttsx3
+from tts_backends import build_router, merge_wav, TTSBackendError
+from stt_partials import PartialCoalescer, PartialStats
+from profiling import RequestProfiler, ContinuousProfiler, attach_thread
 import io
 import os
 import re
@@ -76,12 +77,52 @@ CONFIG = {
     'RATE_LIMIT_PER_MINUTE': 60,
     'VOSK_MODEL_PATH': 'vosk-model-small-en-us-0.15',
     'SAMPLE_RATE': 16000,
-    'CHUNK_SIZE': 4096
+    'CHUNK_SIZE': 4096,
+    # TTS routing: first backend is primary, the rest are hedge/failover targets
+    'TTS_BACKENDS': ['gtts', 'pyttsx3'],
+    'TTS_HEDGING': True,
+    'TTS_HEDGE_DELAY': 2.0,          # seconds, used until the primary has a p95
+    'TTS_CIRCUIT_FAILURES': 5,       # consecutive errors/slow calls before opening
+    'TTS_CIRCUIT_COOLDOWN': 30.0,    # seconds before a half-open trial
+    'TTS_SLOW_CALL_SECONDS': 8.0,
+    # Streaming STT partials: max emits per second per session, delta encoding default
+    'STT_PARTIAL_MAX_RATE': 10,
+    'STT_PARTIAL_DELTAS': False,
+    # Profiling: per-request sampling is only wired in when a token is set
+    'PROFILE_TOKEN': os.environ.get('PROFILE_TOKEN'),
+    'PROFILE_DIR': os.environ.get('PROFILE_DIR', 'profiles'),
+    'PROFILE_INTERVAL': 0.002,
+    'PROFILE_CONTINUOUS_HZ': float(os.environ.get('PROFILE_CONTINUOUS_HZ', 0)),
+    'PROFILE_MAX_FILES': int(os.environ.get('PROFILE_MAX_FILES', 200))
 }
 
 # Rate limiting storage
 rate_limit_store = {}
 
+profiler = RequestProfiler(
+    token=CONFIG['PROFILE_TOKEN'],
+    output_dir=CONFIG['PROFILE_DIR'],
+    interval=CONFIG['PROFILE_INTERVAL'],
+    max_files=CONFIG['PROFILE_MAX_FILES']
+)
+
+# TTS router shared by every synthesis route and event
+tts_router = build_router(
+    CONFIG['TTS_BACKENDS'],
+    hedging=CONFIG['TTS_HEDGING'],
+    default_hedge_delay=CONFIG['TTS_HEDGE_DELAY'],
+    failure_threshold=CONFIG['TTS_CIRCUIT_FAILURES'],
+    cooldown=CONFIG['TTS_CIRCUIT_COOLDOWN'],
+    slow_call_threshold=CONFIG['TTS_SLOW_CALL_SECONDS'],
+    # Pooled synthesis joins the profile of the request it runs for
+    worker_context=attach_thread if profiler.enabled else None
+)
+
+# Streaming STT state per socket session (recognizer + partial coalescer)
+stt_sessions = {}
+stt_sessions_lock = threading.Lock()
+partial_stats = PartialStats()
+
 # Vosk model (lazy loading)
 vosk_model = None
 
@@ -177,8 +218,9 @@ def split_text_for_streaming(text, max_chunk=500):
 
 @app.route('/api/tts', methods=['POST'])
 @rate_limit(limit_per_minute=CONFIG['RATE_LIMIT_PER_MINUTE'])
+@profiler.route
 def text_to_speech():
-    """Convert text to speech using gTTS"""
+    """Convert text to speech via the TTS router (gTTS, hedged with pyttsx3)"""
     try:
         data = request.get_json()
         text = data.get('text', '')
@@ -200,25 +242,25 @@ def text_to_speech():
         
         logger.info(f"TTS request: {len(clean_text)} chars, lang={lang}")
         
-        # Create speech using gTTS
-        tts = gTTS(text=clean_text, lang=lang, slow=slow)
+        result = tts_router.synthesize(clean_text, lang=lang, slow=slow)
         
-        # Save to bytes buffer
-        audio_buffer = io.BytesIO()
-        tts.write_to_fp(audio_buffer)
-        audio_buffer.seek(0)
-        
-        return send_file(
-            audio_buffer,
-            mimetype='audio/mpeg',
+        response = send_file(
+            io.BytesIO(result.audio),
+            mimetype=result.mimetype,
             as_attachment=False
         )
+        response.headers['X-TTS-Backend'] = result.backend
+        return response
+    except TTSBackendError as e:
+        logger.error(f"TTS Error: {e}")
+        return jsonify({'error': str(e)}), 503
     except Exception as e:
         logger.error(f"TTS Error: {e}")
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/tts/stream', methods=['POST'])
 @rate_limit(limit_per_minute=CONFIG['RATE_LIMIT_PER_MINUTE'])
+@profiler.route
 def text_to_speech_stream():
     """Stream TTS for longer texts"""
     try:
@@ -230,23 +272,46 @@ def text_to_speech_stream():
             return jsonify({'error': 'No text provided'}), 400
         
         clean_text = clean_text_for_speech(text)
-        chunks = split_text_for_streaming(clean_text)
+        chunks = [chunk for chunk in split_text_for_streaming(clean_text) if chunk.strip()]
+        
+        if not chunks:
+            return jsonify({'error': 'No valid text after cleaning'}), 400
+        
+        # The first chunk picks the audio format; every later chunk is routed
+        # again (breaker and failover included) among backends of that format
+        first = tts_router.synthesize(chunks[0], lang=lang)
+        same_format = (first.format,)
+        
+        if first.format == 'wav':
+            # WAV files each carry their own header and cannot be concatenated;
+            # merge the frames and send one file instead of a stream
+            rest = [tts_router.synthesize(chunk, lang=lang, formats=same_format).audio
+                    for chunk in chunks[1:]]
+            response = send_file(
+                io.BytesIO(merge_wav([first.audio] + rest)),
+                mimetype=first.mimetype,
+                as_attachment=False
+            )
+            response.headers['X-TTS-Backend'] = first.backend
+            return response
         
         def generate():
-            for chunk in chunks:
-                if chunk.strip():
-                    tts = gTTS(text=chunk, lang=lang, slow=False)
-                    audio_buffer = io.BytesIO()
-                    tts.write_to_fp(audio_buffer)
-                    audio_buffer.seek(0)
-                    yield audio_buffer.read()
-        
-        return Response(generate(), mimetype='audio/mpeg')
+            yield first.audio
+            for chunk in chunks[1:]:
+                yield tts_router.synthesize(chunk, lang=lang, formats=same_format).audio
+        
+        response = Response(generate(), mimetype=first.mimetype)
+        response.headers['X-TTS-Backend'] = first.backend
+        return response
+    except TTSBackendError as e:
+        logger.error(f"TTS Stream Error: {e}")
+        return jsonify({'error': str(e)}), 503
     except Exception as e:
         logger.error(f"TTS Stream Error: {e}")
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/tts/offline', methods=['POST'])
+@profiler.route
 def text_to_speech_offline():
     """Offline TTS using pyttsx3 (system voices)"""
     try:
@@ -260,37 +325,30 @@ def text_to_speech_offline():
         
         clean_text = clean_text_for_speech(text)
         
-        # pyttsx3 for offline TTS
-        engine = pyttsx3.init()
-        engine.setProperty('rate', rate)
-        engine.setProperty('volume', volume)
-        
-        # Save to temp file then read
-        temp_file = f'temp_tts_{int(time.time())}.mp3'
-        engine.save_to_file(clean_text, temp_file)
-        engine.runAndWait()
-        
-        # Read and return
-        if os.path.exists(temp_file):
-            with open(temp_file, 'rb') as f:
-                audio_data = f.read()
-            os.remove(temp_file)
-            
-            return send_file(
-                io.BytesIO(audio_data),
-                mimetype='audio/mpeg',
-                as_attachment=False
-            )
-        else:
-            return jsonify({'error': 'Failed to generate audio'}), 500
-            
+        # Pinned to pyttsx3, but still tracked alongside the other backends
+        result = tts_router.synthesize(clean_text, only='pyttsx3', rate=rate, volume=volume)
+        
+        return send_file(
+            io.BytesIO(result.audio),
+            mimetype=result.mimetype,
+            as_attachment=False
+        )
+    except TTSBackendError as e:
+        logger.error(f"Offline TTS Error: {e}")
+        return jsonify({'error': str(e)}), 503
     except Exception as e:
         logger.error(f"Offline TTS Error: {e}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/tts/backends', methods=['GET'])
+def get_tts_backends():
+    """Per-backend latency, error and circuit breaker stats"""
+    return jsonify(tts_router.stats())
+
 # ============== STT Endpoints ==============
 
 @app.route('/api/stt', methods=['POST'])
+@profiler.route
 def speech_to_text():
     """Convert speech to text using Vosk (offline)"""
     if not VOSK_AVAILABLE:
@@ -335,6 +393,17 @@ def speech_to_text():
         logger.error(f"STT Error: {e}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/stt/stats', methods=['GET'])
+def get_stt_stats():
+    """Streaming partial transcript counters"""
+    with stt_sessions_lock:
+        active = len(stt_sessions)
+    return jsonify({
+        'active_sessions': active,
+        'partial_max_rate': CONFIG['STT_PARTIAL_MAX_RATE'],
+        'partials': partial_stats.to_dict()
+    })
+
 @app.route('/api/stt/config', methods=['GET'])
 def get_stt_config():
     """Get STT configuration and capabilities"""
@@ -350,6 +419,17 @@ def get_stt_config():
         }
     })
 
+# ============== Profiling ==============
+
+@app.route('/api/profiles/<profile_id>', methods=['GET'])
+def get_profile(profile_id):
+    """Download a stored collapsed-stack profile (requires the profiling token)"""
+    supplied = request.headers.get('X-Profile') or request.args.get('profile')
+    path = profiler.path_for(profile_id) if profiler.authorized(supplied) else None
+    if path is None:
+        return jsonify({'error': 'Profile not found'}), 404
+    return send_file(path, mimetype='text/plain', as_attachment=False)
+
 # ============== PDF Export ==============
 
 @app.route('/api/export/pdf', methods=['POST'])
@@ -474,7 +554,7 @@ def health_check():
         'timestamp': datetime.now().isoformat(),
         'capabilities': {
             'tts': True,
-            'tts_offline': True,
+            'tts_offline': any(b.name == 'pyttsx3' for b in tts_router.backends),
             'stt': VOSK_AVAILABLE,
             'vad': VAD_AVAILABLE,
             'pdf_export': PDF_AVAILABLE
@@ -492,9 +572,12 @@ def root():
             '/api/tts': 'POST - Convert text to speech (gTTS)',
             '/api/tts/stream': 'POST - Stream TTS for long texts',
             '/api/tts/offline': 'POST - Offline TTS (pyttsx3)',
+            '/api/tts/backends': 'GET - TTS backend latency and circuit state',
             '/api/stt': 'POST - Speech to text (Vosk)',
             '/api/stt/config': 'GET - STT configuration',
+            '/api/stt/stats': 'GET - Streaming partial transcript counters',
             '/api/export/pdf': 'POST - Export conversation as PDF',
+            '/api/profiles/<id>': 'GET - Stored request profile (profiling token required)',
             '/health': 'GET - Health check'
         },
         'features': {
@@ -515,8 +598,11 @@ def handle_connect():
 @socketio.on('disconnect')
 def handle_disconnect():
     logger.info(f"Client disconnected: {request.sid}")
+    with stt_sessions_lock:
+        stt_sessions.pop(request.sid, None)
 
 @socketio.on('tts_request')
+@profiler.event
 def handle_tts_request(data):
     """Handle TTS request via WebSocket"""
     try:
@@ -526,24 +612,56 @@ def handle_tts_request(data):
             return
         
         clean_text = clean_text_for_speech(text)
-        tts = gTTS(text=clean_text, lang=data.get('lang', 'en'), slow=False)
-        
-        audio_buffer = io.BytesIO()
-        tts.write_to_fp(audio_buffer)
-        audio_buffer.seek(0)
+        result = tts_router.synthesize(clean_text, lang=data.get('lang', 'en'))
         
         # Encode as base64 for WebSocket transfer
-        audio_base64 = base64.b64encode(audio_buffer.read()).decode('utf-8')
+        audio_base64 = base64.b64encode(result.audio).decode('utf-8')
         
         emit('tts_response', {
             'audio': audio_base64,
-            'format': 'mp3',
+            'format': result.format,
+            'backend': result.backend,
             'text': clean_text
         })
     except Exception as e:
         emit('tts_error', {'error': str(e)})
 
+def get_stt_session(sid, model, delta):
+    """Get or create the streaming recognizer and partial coalescer for a session.
+    Delta encoding is fixed by the session's first audio_chunk."""
+    with stt_sessions_lock:
+        session = stt_sessions.get(sid)
+        if session is None:
+            session = {
+                'recognizer': KaldiRecognizer(model, CONFIG['SAMPLE_RATE']),
+                'partials': PartialCoalescer(
+                    partial_stats,
+                    max_rate=CONFIG['STT_PARTIAL_MAX_RATE'],
+                    delta=delta
+                ),
+                'lock': threading.Lock(),
+                'flush_scheduled': False
+            }
+            stt_sessions[sid] = session
+        return session
+
+def flush_held_partial(sid, session, delay):
+    """Send a rate-held partial once its window closes, even if no frame follows"""
+    while True:
+        socketio.sleep(delay)
+        with session['lock']:
+            delay = session['partials'].flush_delay()
+            if delay:
+                # A newer partial was sent meanwhile; wait out its window
+                continue
+            session['flush_scheduled'] = False
+            payload = session['partials'].flush()
+            if payload is not None:
+                socketio.emit('stt_partial', payload, to=sid)
+            return
+
 @socketio.on('audio_chunk')
+@profiler.event
 def handle_audio_chunk(data):
     """Handle streaming audio for STT"""
     if not VOSK_AVAILABLE:
@@ -558,14 +676,33 @@ def handle_audio_chunk(data):
             emit('stt_error', {'error': 'Model not loaded'})
             return
         
-        rec = KaldiRecognizer(model, CONFIG['SAMPLE_RATE'])
-        
-        if rec.AcceptWaveform(audio_data):
-            result = json.loads(rec.Result())
-            emit('stt_final', {'text': result.get('text', '')})
-        else:
-            partial = json.loads(rec.PartialResult())
-            emit('stt_partial', {'text': partial.get('partial', '')})
+        # Only a real boolean opts in or out; strings like "false" are ignored
+        delta = data.get('delta')
+        if not isinstance(delta, bool):
+            delta = CONFIG['STT_PARTIAL_DELTAS']
+        session = get_stt_session(request.sid, model, delta)
+        partials = session['partials']
+        
+        with session['lock']:
+            rec = session['recognizer']
+            if rec.AcceptWaveform(audio_data):
+                result = json.loads(rec.Result())
+                partials.reset()
+                emit('stt_final', {'text': result.get('text', '')})
+                return
+            partial = json.loads(rec.PartialResult()).get('partial', '')
+            
+            # Only changed partials are sent, coalesced to the per-session rate.
+            # Offer and emit stay under the session lock so partials keep their order.
+            payload = partials.offer(partial)
+            if payload is not None:
+                emit('stt_partial', payload)
+                return
+            
+            delay = partials.flush_delay()
+            if delay is not None and not session['flush_scheduled']:
+                session['flush_scheduled'] = True
+                socketio.start_background_task(flush_held_partial, request.sid, session, delay)
             
     except Exception as e:
         emit('stt_error', {'error': str(e)})
@@ -574,15 +711,28 @@ def handle_audio_chunk(data):
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
+    debug = True
     
     print("=" * 60)
     print("🎙️  AI Coaching Speech Server v2.0.0")
     print("=" * 60)
     print(f"📡 Running on http://localhost:{port}")
-    print(f"🔊 TTS: gTTS (online) + pyttsx3 (offline)")
+    print(f"🔊 TTS: {' -> '.join(b.name for b in tts_router.backends)} (hedging {'on' if CONFIG['TTS_HEDGING'] else 'off'})")
     print(f"🎤 STT: {'Vosk (offline)' if VOSK_AVAILABLE else 'Web Speech API (browser)'}")
     print(f"📄 PDF Export: {'Available' if PDF_AVAILABLE else 'Not available'}")
     print(f"🔒 Rate Limit: {CONFIG['RATE_LIMIT_PER_MINUTE']} requests/minute")
+    print(f"🔬 Profiling: {'per-request (token set)' if profiler.enabled else 'disabled'}, "
+          f"continuous {CONFIG['PROFILE_CONTINUOUS_HZ']}Hz")
     print("=" * 60)
     
-    socketio.run(app, host='0.0.0.0', port=port, debug=True, allow_unsafe_werkzeug=True)
+    # With the debug reloader this block also runs in the watcher process;
+    # only the serving process (WERKZEUG_RUN_MAIN) should sample
+    serving_process = not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true'
+    if CONFIG['PROFILE_CONTINUOUS_HZ'] > 0 and serving_process:
+        ContinuousProfiler(
+            CONFIG['PROFILE_DIR'],
+            hz=CONFIG['PROFILE_CONTINUOUS_HZ'],
+            max_files=CONFIG['PROFILE_MAX_FILES']
+        ).start()
+    
+    socketio.run(app, host='0.0.0.0', port=port, debug=debug, allow_unsafe_werkzeug=True)
@@ -0,0 +1,126 @@
+"""
+Partial transcript emission for streaming STT
+=====================================================
+Partial results are only sent when they change, at most
+max_rate times per second per session, and optionally as
+deltas against the previous partial:
+- {'op': 'append', 'text': suffix, 'seq': n}
+- {'op': 'replace', 'offset': k, 'text': tail, 'seq': n}
+  (client keeps previous[:k] and appends tail)
+A final result resets the baseline, so the next delta appends to ''.
+A partial held back by the rate window is sent with the next frame, or by
+flush() once the window closes if the client stops sending frames.
+"""
+
+import time
+import threading
+
+
+class PartialStats:
+    """Counters shared by every session"""
+
+    def __init__(self):
+        self.emitted = 0
+        self.deltas = 0
+        self.suppressed_unchanged = 0
+        self.suppressed_rate = 0
+        self.superseded = 0
+        self._lock = threading.Lock()
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + amount)
+
+    def to_dict(self):
+        with self._lock:
+            suppressed = self.suppressed_unchanged + self.suppressed_rate + self.superseded
+            return {
+                'emitted': self.emitted,
+                'deltas': self.deltas,
+                'suppressed': suppressed,
+                'suppressed_unchanged': self.suppressed_unchanged,
+                'suppressed_rate': self.suppressed_rate,
+                'superseded_by_final': self.superseded,
+            }
+
+
+class PartialCoalescer:
+    """Per-session change detection, rate limiting and delta encoding"""
+
+    def __init__(self, stats, max_rate=10.0, delta=False):
+        self.stats = stats
+        self.min_interval = 1.0 / max_rate if max_rate > 0 else 0.0
+        self.delta = delta
+        self.last_sent = ''
+        self.last_emit_at = 0.0
+        self.pending = None
+        self.seq = 0
+        self._lock = threading.Lock()
+
+    def offer(self, text):
+        """Feed the latest partial; returns a payload to emit or None"""
+        with self._lock:
+            now = time.monotonic()
+            if text == self.last_sent:
+                if self.pending is not None:
+                    # Reverted to what the client already shows
+                    self.pending = None
+                    self.stats.incr('suppressed_rate')
+                self.stats.incr('suppressed_unchanged')
+                return None
+
+            if now - self.last_emit_at < self.min_interval:
+                if self.pending is not None:
+                    # The held partial is replaced without ever being sent
+                    self.stats.incr('suppressed_rate')
+                self.pending = text
+                return None
+
+            if self.pending is not None and self.pending != text:
+                # A different held partial is dropped in favour of this one
+                self.stats.incr('suppressed_rate')
+            self.pending = None
+            return self._payload_locked(text, now)
+
+    def flush_delay(self):
+        """Seconds until a held partial may be sent, or None if nothing is held"""
+        with self._lock:
+            if self.pending is None:
+                return None
+            return max(0.0, self.min_interval - (time.monotonic() - self.last_emit_at))
+
+    def flush(self):
+        """Send the held partial, if any; used when no further frame arrives"""
+        with self._lock:
+            if self.pending is None:
+                return None
+            text, self.pending = self.pending, None
+            return self._payload_locked(text, time.monotonic())
+
+    def reset(self):
+        """A final result supersedes any partial; the next partial starts fresh"""
+        with self._lock:
+            if self.pending is not None:
+                self.stats.incr('superseded')
+            self.pending = None
+            self.last_sent = ''
+            self.last_emit_at = 0.0
+
+    def _payload_locked(self, text, now):
+        previous = self.last_sent
+        self.last_sent = text
+        self.last_emit_at = now
+        self.seq += 1
+        self.stats.incr('emitted')
+
+        if not self.delta:
+            return {'text': text}
+
+        self.stats.incr('deltas')
+        offset = 0
+        limit = min(len(previous), len(text))
+        while offset < limit and previous[offset] == text[offset]:
+            offset += 1
+        if offset == len(previous):
+            return {'op': 'append', 'text': text[offset:], 'seq': self.seq}
+        return {'op': 'replace', 'offset': offset, 'text': text[offset:], 'seq': self.seq}
@@ -0,0 +1,518 @@
+"""
+Pluggable TTS backends for the AI Coaching speech servers
+=====================================================
+Every synthesis path goes through a TTSRouter which:
+- Tracks latency (rolling p95) and errors for each backend
+- Hedges: if the primary has not answered within its observed p95,
+  the secondary (offline) backend is started and the first result wins
+- Circuit-breaks a degraded backend (repeated errors or slow calls)
+  so traffic is routed around it until a cool-down trial succeeds
+- Runs each backend on its own pool sized to its real concurrency and
+  never queues a hedge: a busy backend is simply not used as a target
+"""
+
+import io
+import os
+import time
+import wave
+import logging
+import tempfile
+import threading
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+# Optional imports with graceful fallback
+try:
+    from gtts import gTTS
+    GTTS_AVAILABLE = True
+except ImportError:
+    GTTS_AVAILABLE = False
+
+try:
+    import pyttsx3
+    PYTTSX3_AVAILABLE = True
+except ImportError:
+    PYTTSX3_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+
+class TTSBackendError(Exception):
+    """Raised when no backend could synthesize the requested text"""
+
+
+class TTSResult:
+    """Audio produced by a backend, plus routing metadata"""
+
+    def __init__(self, audio, backend, mimetype, audio_format, latency, hedged=False):
+        self.audio = audio
+        self.backend = backend
+        self.mimetype = mimetype
+        self.format = audio_format
+        self.latency = latency
+        self.hedged = hedged
+
+
+# ============== Backends ==============
+
+class TTSBackend:
+    """Base class - subclasses implement synthesize() and return raw audio bytes"""
+
+    name = 'base'
+    mimetype = 'application/octet-stream'
+    format = 'bin'
+    available = False
+    # Calls the backend can serve at once; None uses the router's max_workers
+    concurrency = None
+
+    def supports(self, lang):
+        """Whether this backend can speak the requested language"""
+        return True
+
+    def synthesize(self, text, lang='en', slow=False, **options):
+        raise NotImplementedError
+
+
+class GTTSBackend(TTSBackend):
+    """Google Translate TTS (online, mp3)"""
+
+    name = 'gtts'
+    mimetype = 'audio/mpeg'
+    format = 'mp3'
+    available = GTTS_AVAILABLE
+
+    def synthesize(self, text, lang='en', slow=False, **options):
+        tts = gTTS(text=text, lang=lang, slow=slow)
+        audio_buffer = io.BytesIO()
+        tts.write_to_fp(audio_buffer)
+        return audio_buffer.getvalue()
+
+
+class Pyttsx3Backend(TTSBackend):
+    """System voices via pyttsx3 (offline, wav)"""
+
+    name = 'pyttsx3'
+    mimetype = 'audio/wav'
+    format = 'wav'
+    available = PYTTSX3_AVAILABLE
+    # pyttsx3 shares one engine per driver and its event loop is not re-entrant
+    concurrency = 1
+    _lock = threading.Lock()
+
+    def __init__(self, languages=('en',)):
+        # Languages the installed system voice can actually speak
+        self.languages = {l.lower() for l in languages}
+
+    def supports(self, lang):
+        return (lang or 'en').split('-')[0].lower() in self.languages
+
+    def synthesize(self, text, lang='en', slow=False, **options):
+        rate = options.get('rate') or (110 if slow else 150)
+        volume = options.get('volume', 1.0)
+
+        fd, temp_file = tempfile.mkstemp(prefix='tts_', suffix='.wav')
+        os.close(fd)
+        try:
+            with self._lock:
+                engine = pyttsx3.init()
+                engine.setProperty('rate', rate)
+                engine.setProperty('volume', volume)
+                engine.save_to_file(text, temp_file)
+                engine.runAndWait()
+            with open(temp_file, 'rb') as f:
+                audio_data = f.read()
+        finally:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+
+        if not audio_data:
+            raise TTSBackendError('pyttsx3 produced no audio')
+        return audio_data
+
+
+def merge_wav(parts):
+    """Join complete WAV files into one, keeping the first file's format"""
+    output = io.BytesIO()
+    writer = None
+    for part in parts:
+        with wave.open(io.BytesIO(part), 'rb') as reader:
+            if writer is None:
+                writer = wave.open(output, 'wb')
+                writer.setparams(reader.getparams())
+            writer.writeframes(reader.readframes(reader.getnframes()))
+    if writer is not None:
+        writer.close()
+    return output.getvalue()
+
+
+BACKENDS = {
+    GTTSBackend.name: GTTSBackend,
+    Pyttsx3Backend.name: Pyttsx3Backend,
+}
+
+
+# ============== Health Tracking ==============
+
+class BackendHealth:
+    """Rolling latency/error window and circuit breaker for one backend"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, window=200, failure_threshold=5, cooldown=30.0, slow_call_threshold=8.0):
+        self.latencies = deque(maxlen=window)
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.slow_call_threshold = slow_call_threshold
+
+        self.successes = 0
+        self.errors = 0
+        self.slow_calls = 0
+        self.consecutive_failures = 0
+        self.state = self.CLOSED
+        self.opened_at = 0.0
+        self.trial_started_at = None
+        self.last_error = None
+        self._lock = threading.Lock()
+
+    def p95(self, min_samples=10):
+        """95th percentile latency in seconds, or None until enough samples exist"""
+        with self._lock:
+            samples = sorted(self.latencies)
+        if len(samples) < min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+
+    def allow_request(self):
+        """Whether the breaker lets a call through (claims the half-open trial slot)"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            now = time.time()
+            if self.state == self.OPEN and now - self.opened_at >= self.cooldown:
+                self.state = self.HALF_OPEN
+                self.trial_started_at = None
+            if self.state == self.HALF_OPEN:
+                # One trial at a time; a claimed slot that never reported back expires
+                if self.trial_started_at is None or now - self.trial_started_at >= self.cooldown:
+                    self.trial_started_at = now
+                    return True
+            return False
+
+    def record_success(self, latency):
+        with self._lock:
+            self.latencies.append(latency)
+            self.successes += 1
+            if latency >= self.slow_call_threshold:
+                # A slow answer still counts against the backend's health
+                self.slow_calls += 1
+                self._record_failure_locked()
+                return
+            self.consecutive_failures = 0
+            if self.state != self.CLOSED:
+                logger.info("TTS backend recovered, closing circuit")
+            self.state = self.CLOSED
+            self.trial_started_at = None
+
+    def record_error(self, error):
+        with self._lock:
+            self.errors += 1
+            self.last_error = str(error)
+            self._record_failure_locked()
+
+    def _record_failure_locked(self):
+        self.consecutive_failures += 1
+        if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logger.warning(
+                    f"TTS backend degraded ({self.consecutive_failures} consecutive failures), "
+                    f"opening circuit for {self.cooldown}s"
+                )
+            self.state = self.OPEN
+            self.opened_at = time.time()
+            self.trial_started_at = None
+
+    def stats(self):
+        p95 = self.p95()
+        with self._lock:
+            samples = list(self.latencies)
+            return {
+                'state': self.state,
+                'successes': self.successes,
+                'errors': self.errors,
+                'slow_calls': self.slow_calls,
+                'consecutive_failures': self.consecutive_failures,
+                'last_error': self.last_error,
+                'samples': len(samples),
+                'avg_latency_ms': round(sum(samples) / len(samples) * 1000, 1) if samples else None,
+                'p95_latency_ms': round(p95 * 1000, 1) if p95 is not None else None,
+            }
+
+
+# ============== Router ==============
+
+class TTSRouter:
+    """Routes synthesis across backends with hedging and circuit breaking"""
+
+    def __init__(self, backends, hedging=True, default_hedge_delay=2.0,
+                 min_hedge_delay=0.1, max_workers=16, worker_context=None, **health_options):
+        # First entry is the primary, the rest are failover/hedge targets in order
+        self.backends = [b for b in backends if b.available]
+        if not self.backends:
+            raise TTSBackendError('No TTS backend available')
+        self.health = {b.name: BackendHealth(**health_options) for b in self.backends}
+        self.hedging = hedging
+        # Optional context manager factory entered around each pooled call;
+        # pooled calls run in a copy of the caller's contextvars
+        self.worker_context = worker_context
+        self.default_hedge_delay = default_hedge_delay
+        self.min_hedge_delay = min_hedge_delay
+        self.hedged_requests = 0
+        self.secondary_wins = 0
+        self._counter_lock = threading.Lock()
+
+        # Each backend gets its own pool sized to its real concurrency, and a
+        # slot is taken before submitting, so pooled calls never sit in a queue
+        self._slots = {}
+        self._executors = {}
+        for b in self.backends:
+            size = b.concurrency or max_workers
+            self._slots[b.name] = threading.BoundedSemaphore(size)
+            self._executors[b.name] = ThreadPoolExecutor(
+                max_workers=size, thread_name_prefix=f'tts-{b.name}'
+            )
+
+    @property
+    def primary(self):
+        return self.backends[0]
+
+    def get(self, name):
+        for backend in self.backends:
+            if backend.name == name:
+                return backend
+        raise TTSBackendError(f'TTS backend not available: {name}')
+
+    def hedge_delay(self, backend):
+        """How long to wait on a backend before starting the next one"""
+        p95 = self.health[backend.name].p95()
+        if p95 is None:
+            return self.default_hedge_delay
+        return max(self.min_hedge_delay, p95)
+
+    def synthesize(self, text, lang='en', slow=False, only=None, formats=None, **options):
+        """Synthesize text, returning a TTSResult.
+        `only` pins a single backend by name; `formats` restricts routing to
+        backends producing one of the given audio formats."""
+        if only is not None:
+            return self._call(self.get(only), text, lang, slow, options)
+
+        candidates = [b for b in self.backends
+                      if b.supports(lang) and (formats is None or b.format in formats)]
+        if not candidates:
+            raise TTSBackendError(f'No TTS backend supports language: {lang}')
+
+        if not self.hedging or len(candidates) == 1:
+            return self._failover(candidates, text, lang, slow, options)
+        return self._hedged(candidates, text, lang, slow, options)
+
+    def _next_allowed(self, remaining, launched_any):
+        """Pop the next backend whose circuit admits a call.
+        The breaker is only consulted for a backend that is about to run, so a
+        half-open trial slot is never claimed without a call behind it."""
+        while remaining:
+            backend = remaining.pop(0)
+            if self.health[backend.name].allow_request():
+                return backend
+            if not remaining and not launched_any:
+                # Every circuit is open - fail open rather than refuse outright
+                return backend
+        return None
+
+    def _count(self, name):
+        with self._counter_lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def _call(self, backend, text, lang, slow, options, slot_held=False):
+        """Run one synthesis, timing only the backend's own work.
+        Waiting for a free slot is not counted as backend latency. Backends
+        without a concurrency limit run inline in the caller's thread."""
+        slot = self._slots[backend.name]
+        if backend.concurrency is None:
+            slot_held = True
+        elif not slot_held:
+            slot.acquire()
+        try:
+            start = time.perf_counter()
+            try:
+                audio = backend.synthesize(text, lang=lang, slow=slow, **options)
+            except Exception as e:
+                self.health[backend.name].record_error(e)
+                logger.warning(f"TTS backend {backend.name} failed: {e}")
+                raise
+            latency = time.perf_counter() - start
+        finally:
+            if not slot_held:
+                slot.release()
+        self.health[backend.name].record_success(latency)
+        return TTSResult(audio, backend.name, backend.mimetype, backend.format, latency)
+
+    def _submit(self, attempt, text, lang, slow, options, slot_held=False):
+        """Submit on the backend's own pool; returns False if it has no free slot"""
+        backend = attempt.backend
+        slot = self._slots[backend.name]
+        if not slot_held and not slot.acquire(blocking=False):
+            return False
+
+        context = contextvars.copy_context() if self.worker_context is not None else None
+
+        def run():
+            attempt.started_at = time.perf_counter()
+            if context is None:
+                return self._call(backend, text, lang, slow, options, slot_held=True)
+            with self.worker_context():
+                return self._call(backend, text, lang, slow, options, slot_held=True)
+
+        future = self._executors[backend.name].submit(context.run, run) if context else \
+            self._executors[backend.name].submit(run)
+        # Released on completion or cancellation, whichever comes first
+        future.add_done_callback(lambda _: slot.release())
+        attempt.future = future
+        return True
+
+    def _next_hedge(self, remaining):
+        """Pop the first backend with a free slot whose circuit admits a call.
+        The slot is taken before the breaker is asked, so a busy backend never
+        claims a half-open trial it cannot run. Returns it with its slot held."""
+        for i, backend in enumerate(remaining):
+            slot = self._slots[backend.name]
+            if not slot.acquire(blocking=False):
+                continue
+            if self.health[backend.name].allow_request():
+                return remaining.pop(i)
+            slot.release()
+        return None
+
+    def _failover(self, candidates, text, lang, slow, options, launched_any=False):
+        last_error = None
+        remaining = list(candidates)
+        while True:
+            backend = self._next_allowed(remaining, launched_any)
+            if backend is None:
+                break
+            launched_any = True
+            try:
+                return self._call(backend, text, lang, slow, options)
+            except Exception as e:
+                last_error = e
+        raise TTSBackendError(f'All TTS backends failed: {last_error}')
+
+    def _hedged(self, candidates, text, lang, slow, options):
+        remaining = list(candidates)
+        primary = self._next_allowed(remaining, False)
+        attempt = _Attempt(primary)
+        if not self._submit(attempt, text, lang, slow, options):
+            # The primary is saturated; hedging would only add load, so wait
+            # for it like an unhedged request
+            try:
+                return self._call(primary, text, lang, slow, options)
+            except Exception:
+                return self._failover(remaining, text, lang, slow, options, launched_any=True)
+
+        pending = {attempt.future: attempt}
+        current = attempt
+        last_error = None
+        # Re-check interval while every hedge target is busy
+        busy_poll = 0.05
+
+        while pending:
+            timeout = None
+            if remaining:
+                if current.started_at is None:
+                    timeout = 0.01
+                else:
+                    # Measured from when the backend started, not from submission
+                    elapsed = time.perf_counter() - current.started_at
+                    timeout = max(0.0, self.hedge_delay(current.backend) - elapsed)
+            done, _ = wait(list(pending), timeout=timeout, return_when=FIRST_COMPLETED)
+
+            if not done:
+                if current.started_at is None:
+                    continue
+                elapsed = time.perf_counter() - current.started_at
+                if elapsed < self.hedge_delay(current.backend):
+                    continue
+                backend = self._next_hedge(remaining)
+                if backend is None:
+                    # Every hedge target is busy or circuit-open; queueing behind
+                    # it would only add load, so keep waiting on what is running
+                    done, _ = wait(list(pending), timeout=busy_poll, return_when=FIRST_COMPLETED)
+                else:
+                    hedge = _Attempt(backend)
+                    self._submit(hedge, text, lang, slow, options, slot_held=True)
+                    self._count('hedged_requests')
+                    logger.info(f"Hedging TTS request: {current.backend.name} exceeded {elapsed:.2f}s")
+                    pending[hedge.future] = hedge
+                    current = hedge
+                    continue
+                if not done:
+                    continue
+
+            for future in done:
+                finished = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    last_error = e
+                    continue
+                result.hedged = finished.backend is not candidates[0]
+                if result.hedged:
+                    self._count('secondary_wins')
+                # Calls that already started keep running to feed the health
+                # stats; anything not yet started is dropped
+                for loser in pending:
+                    loser.cancel()
+                return result
+
+        if remaining:
+            # Everything launched failed; fall back to the rest in order
+            try:
+                return self._failover(remaining, text, lang, slow, options, launched_any=True)
+            except TTSBackendError as e:
+                last_error = e
+        raise TTSBackendError(f'All TTS backends failed: {last_error}')
+
+    def stats(self):
+        with self._counter_lock:
+            hedged_requests, secondary_wins = self.hedged_requests, self.secondary_wins
+        return {
+            'primary': self.primary.name,
+            'hedging': self.hedging,
+            'hedged_requests': hedged_requests,
+            'secondary_wins': secondary_wins,
+            'backends': {
+                b.name: dict(self.health[b.name].stats(),
+                             hedge_delay_ms=round(self.hedge_delay(b) * 1000, 1))
+                for b in self.backends
+            },
+        }
+
+
+class _Attempt:
+    """One backend call within a hedged request"""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.future = None
+        self.started_at = None
+
+
+def build_router(names, **options):
+    """Create a TTSRouter from an ordered list of backend names"""
+    backends = []
+    for name in names:
+        if name not in BACKENDS:
+            raise TTSBackendError(f'Unknown TTS backend: {name}')
+        backends.append(BACKENDS[name]())
+    return TTSRouter(backends, **options)
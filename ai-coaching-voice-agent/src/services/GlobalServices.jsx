@@ -790,7 +790,7 @@ export const stopSpeaking = () => {
 
 /**
  * Convert text to speech with fallback chain:
- * 1. Python TTS Server (gTTS - natural voice)
+ * 1. Python TTS Server (gTTS - natural voice, offline pyttsx3 failover)
  * 2. Browser Web Speech API (built-in)
  */
 export const ConvertTextToSpeech = async (text, onStart, onEnd) => {
@@ -820,7 +820,9 @@ export const ConvertTextToSpeech = async (text, onStart, onEnd) => {
 
         pythonServerAvailable = true;
 
-        const audioBlob = new Blob([response.data], { type: 'audio/mpeg' });
+        // The server may answer from its offline backend (WAV) when gTTS is slow or down
+        const audioType = response.headers['content-type'] || 'audio/mpeg';
+        const audioBlob = new Blob([response.data], { type: audioType });
         const audioUrl = URL.createObjectURL(audioBlob);
         currentAudio = new Audio(audioUrl);
         